@@ -1,26 +1,53 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
+from functools import lru_cache
+import hashlib
+import json
 import os
 import sys
 import time
 
 from atproto import Client, client_utils, models
 from bs4 import BeautifulSoup
-import feedparser
+from lxml import etree
 import requests
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 
 BEEHIVE_FULL_RSS_FEED = "https://www.beehive.govt.nz/rss.xml"
 START_TIME = datetime.strptime("05 Apr 2025 00:00:01 +1300", "%d %b %Y %H:%M:%S %z")
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 POST_LIMIT = int(os.environ.get("POST_LIMIT", 3))
+FETCH_WORKERS = 8
+# How long an uploaded thumbnail blob reference is reused before re-uploading
+THUMB_REFRESH_DAYS = 7
+
+# Shared across threads so TCP/TLS connections to Browserless are pooled
+# rather than re-handshaking on every request. The pool is sized to cover
+# every fetch worker holding a connection at once.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 class PostType(Enum):
     RELEASE = 1
     SPEECH = 2
     FEATURE = 3
 
+# URL path segments mapped to post types; first match wins
+_TYPE_MAP = (
+    ('/release/', PostType.RELEASE),
+    ('/speech/', PostType.SPEECH),
+    ('/feature/', PostType.FEATURE),
+)
+
 class Minister:
+    __slots__ = ('name', 'slug', 'portfolios')
+
     def __init__(self, name: str, slug: str, portfolios: list[str] = None):
         self.name = name
         self.slug = slug
@@ -36,6 +63,8 @@ class Minister:
         return self.__str__()
 
 class Post:
+    __slots__ = ('type', 'guid', 'url', 'title', 'ministers')
+
     def __init__(self, type: PostType, guid: str, url: str, title: str, ministers: list[Minister] = None):
         self.type = type
         self.guid = guid
@@ -74,43 +103,88 @@ def scrape_url(url):
 
     scrape_params = {"token": browserless_api_token, "stealth": True}
 
-    return requests.post(scrape_url, params=scrape_params, json={"url": url})
+    return session.post(scrape_url, params=scrape_params, json={"url": url}, timeout=30)
 
 def fetch_post_metadata(post):
-    r = scrape_url(post.url)
+    # Runs inside the fetch thread pool so an exception here would abort the
+    # whole run via executor.map; report and return False like a bad status
+    try:
+        r = scrape_url(post.url)
+    except requests.RequestException as e:
+        print(f"Failed to fetch {post.url}: {e}")
+        return False
     if not r.ok:
         return False
-    soup = BeautifulSoup(r.text, 'html.parser')
+    tree = LexborHTMLParser(r.text)
     # TODO: There is more complexity to actually map ministers to their correct portfolios which will
     # be implemented later. This will do for now.
     metadata = {'title': None, 'description': None, 'ministers': [], 'portfolios': []}
 
-    # Page metadata
-    title = soup.find("meta", attrs={"property": "og:title"}).attrs.get('content', '').strip()
-    if title == "":
-        title = soup.find('h1', class_='article__title').text.strip()
-    metadata['title'] = title
-
-    description = soup.find("meta", attrs={"property": "og:description"}).attrs.get('content', '').strip()
-    if description == "":
-        description = soup.find('meta', attrs={"name": "description"}).attrs.get('content', '').strip()
-    metadata['description'] = description
-
-    # Ministers
-    ministers = soup.find_all('div', class_='minister__title')
-    for minister in ministers:
-        metadata['ministers'].append(minister.text.strip())
-    # portfolios = soup.find_all('div', class_='taxonomy-term--type-portfolios')
+    # Grab everything we care about in a single pass over the document rather
+    # than one traversal per selector
+    title = ''
+    fallback_title = ''
+    description = ''
+    fallback_description = ''
+    selector = ', '.join([
+        'meta[property="og:title"]',
+        'meta[property="og:description"]',
+        'meta[name="description"]',
+        'h1.article__title',
+        'div.minister__title',
+    ])
+    for node in tree.css(selector):
+        if node.tag == 'meta':
+            content = (node.attributes.get('content') or '').strip()
+            if node.attributes.get('property') == 'og:title':
+                title = content
+            elif node.attributes.get('property') == 'og:description':
+                description = content
+            else:
+                fallback_description = content
+        elif node.tag == 'h1':
+            fallback_title = node.text().strip()
+        else:
+            metadata['ministers'].append(node.text().strip())
+
+    metadata['title'] = title if title != "" else fallback_title
+    metadata['description'] = description if description != "" else fallback_description
+    # portfolios = tree.css('div.taxonomy-term--type-portfolios')
     # for portfolio in portfolios:
-    #     metadata['portfolios'].append(portfolio.text.strip())
+    #     metadata['portfolios'].append(portfolio.text().strip())
 
     return metadata
 
-def format_minister_text(ministers):
+def get_thumb_blob(client):
+    # In order to avoid wasted bandwidth, as the image is always the same, we
+    # upload a local copy and cache the returned blob reference so repeat
+    # posts (and repeat runs) don't re-upload identical bytes
+    cache_path = os.path.join(SCRIPT_DIR, "thumb_blob.json")
+    if os.path.exists(cache_path):
+        with open(cache_path) as file:
+            cached = json.load(file)
+        uploaded_at = datetime.fromisoformat(cached['uploaded_at'])
+        if datetime.now(timezone.utc) - uploaded_at < timedelta(days=THUMB_REFRESH_DAYS):
+            return models.blob_ref.BlobRef.model_validate(cached['blob'])
+
+    with open(os.path.join(SCRIPT_DIR, 'beehive.png'), 'rb') as file:
+        img_data = file.read()
+    thumb = client.upload_blob(img_data)
+    with open(cache_path, "w") as file:
+        json.dump({
+            'uploaded_at': datetime.now(timezone.utc).isoformat(),
+            'blob': json.loads(thumb.blob.model_dump_json()),
+        }, file)
+    return thumb.blob
+
+@lru_cache(maxsize=256)
+def format_minister_text(ministers: tuple[str, ...]):
     """
     1 Minister: "A new release from X"
     2 Ministers: "A new release from X and Y"
     3+ Ministers: "A new release from X, Y and Z"
+
+    Takes a tuple so repeated minister combinations hit the cache
     """
     prefix = ' from'
     if len(ministers) == 0:
@@ -124,6 +198,24 @@ def format_minister_text(ministers):
         firstBit = ', '.join(ministers[:-1])
         return f'{prefix} {firstBit} and {ministers[-1]}'
 
+# The only fields we actually use from each RSS item
+FeedEntry = namedtuple('FeedEntry', ['link', 'guid', 'title', 'published'])
+
+def parse_rss_entries(feed_text):
+    # feedparser spends most of its time sanitising and building nested dicts
+    # for fields we never read, so pull the four fields we care about straight
+    # out of the XML instead
+    root = etree.fromstring(feed_text.encode())
+    entries = []
+    for item in root.iter('item'):
+        entries.append(FeedEntry(
+            link=item.findtext('link', '').strip(),
+            guid=item.findtext('guid', '').strip(),
+            title=item.findtext('title', '').strip(),
+            published=item.findtext('pubDate', '').strip(),
+        ))
+    return entries
+
 def fetch_remote_rss_feed():
     r = scrape_url(BEEHIVE_FULL_RSS_FEED)
     if not r.ok:
@@ -131,37 +223,53 @@ def fetch_remote_rss_feed():
         sys.exit(1)
     # Browser response comes wrapped in HTML tags so we need to strip them out
     soup = BeautifulSoup(r.text, 'html.parser')
-    return feedparser.parse(soup.pre.text)
+    feed_text = soup.pre.text
+    # Browserless doesn't forward caching headers so we hash the feed body
+    # ourselves and skip parsing entirely when nothing has changed since the
+    # last fully handled run
+    feed_hash = hashlib.sha256(feed_text.encode()).hexdigest()
+    state_path = os.path.join(SCRIPT_DIR, "feed_state.txt")
+    if os.path.exists(state_path):
+        with open(state_path) as file:
+            if file.read().strip() == feed_hash:
+                print("Feed is unchanged since the last run")
+                return [], None
+    return parse_rss_entries(feed_text), feed_hash
+
+def save_feed_state(feed_hash):
+    # Only call this once every new entry in the feed body has actually been
+    # published; writing the hash any earlier would stop entries that were
+    # deferred by POST_LIMIT or that failed to fetch/post from being retried
+    # on the next run
+    with open(os.path.join(SCRIPT_DIR, "feed_state.txt"), "w") as file:
+        file.write(feed_hash)
 
 def fetch_local_rss_feed():
     with open(os.path.join(SCRIPT_DIR, "example.xml"), "r") as file:
         data = file.read()
-    return feedparser.parse(data)
+    return parse_rss_entries(data)
 
 def load_feed_history():
+    # Only the guid column is ever consulted so stream the rows straight into
+    # a set rather than materialising a dict per row; membership checks in the
+    # main loop stay O(1) no matter how large the history grows
     if os.path.exists(os.path.join(SCRIPT_DIR, "history.csv")):
         with open(os.path.join(SCRIPT_DIR, "history.csv")) as csvfile:
-            return list(csv.DictReader(csvfile))
-    return []
-
-def save_feed_history(history, post):
-    history.append({
-        'guid': post.guid,
-        'url': post.url
-    })
-    with open(os.path.join(SCRIPT_DIR, "history.csv"), "w", newline="") as csvfile:
-        fieldnames = ['guid', 'url']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for row in history:
-            writer.writerow(row)
-
-def retrieve_published_guids(history):
-    guids = []
-    for row in history:
-        guids.append(row['guid'])
-    return guids
+            reader = csv.reader(csvfile)
+            next(reader, None) # skip the header
+            return {row[0] for row in reader if row}
+    return set()
+
+def save_feed_history(guids, post):
+    guids.add(post.guid)
+    # Append just the new row rather than rewriting the whole file each time
+    history_path = os.path.join(SCRIPT_DIR, "history.csv")
+    write_header = not os.path.exists(history_path)
+    with open(history_path, "a", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        if write_header:
+            writer.writerow(['guid', 'url'])
+        writer.writerow([post.guid, post.url])
 
 def parse_entry(entry):
     url = entry.link
@@ -171,14 +279,8 @@ def parse_entry(entry):
     # allocated a node number as well.
     guid = entry.guid
     title = entry.title.strip()
-    entry_type = None
-
-    if '/feature/' in url:
-        entry_type = PostType.FEATURE
-    if '/release/' in url:
-        entry_type = PostType.RELEASE
-    if '/speech/' in url:
-        entry_type = PostType.SPEECH
+
+    entry_type = next((post_type for token, post_type in _TYPE_MAP if token in url), None)
     if entry_type is None:
         print("No idea what this entry is!")
         return None
@@ -186,31 +288,53 @@ def parse_entry(entry):
     return Post(entry_type, guid, url, title)
 
 if __name__ == "__main__":
-    feed = fetch_remote_rss_feed()
-    history = load_feed_history()
-    guids = retrieve_published_guids(history)
-    posts_published = 0
+    entries, feed_hash = fetch_remote_rss_feed()
+    guids = load_feed_history()
     # Feed items are not 100% strictly time ordered but it's possible for feeds
     # to be backdated so we won't bother with ordering too much. Despite that,
     # we'll still reverse the order so "older" items are published first
-    posts = []
-    for entry in reversed(feed.entries):
-        if posts_published >= POST_LIMIT:
+    candidates = []
+    # Tracks whether every new entry in this feed body ended up published;
+    # anything deferred or failed means we can't mark the body as handled
+    run_complete = True
+    for entry in reversed(entries):
+        if len(candidates) >= POST_LIMIT:
             print(f"Reached post limit of {POST_LIMIT}, stopping")
+            run_complete = False
             break
-        parsed_datetime = datetime.strptime(entry.published, "%a, %d %b %Y %H:%M:%S %z")
-        # When bootstrapping the feed, we don't want to publish items that are too old.
-        if parsed_datetime < START_TIME:
-            print(f"Skipped {entry.link} for being older than {START_TIME}")
-            continue
-        # If post is already published, skip parsing it
+        # Most entries have already been syndicated, so check the guid set
+        # first and only do the costlier parsing for entries that survive
         if entry.guid in guids:
             print(f"Skipped {entry.link} as it has already been syndicated")
             continue
         post = parse_entry(entry)
-        if post is not None:
-            # We've never seen this post before so we'll fetch further data about it
-            metadata = fetch_post_metadata(post)
+        if post is None:
+            continue
+        # parsedate_to_datetime handles the RFC 822 pubDate format directly and
+        # is much cheaper than a strptime call per entry. Both datetimes are
+        # timezone-aware so the comparison is correct whatever offset the feed
+        # publishes in
+        parsed_datetime = parsedate_to_datetime(entry.published)
+        # When bootstrapping the feed, we don't want to publish items that are too old.
+        if parsed_datetime < START_TIME:
+            print(f"Skipped {entry.link} for being older than {START_TIME}")
+            continue
+        candidates.append(post)
+        guids.add(post.guid)
+
+    # Each metadata fetch is an independent Browserless round trip so we run
+    # them concurrently. Posting to Bluesky stays serial below to preserve
+    # ordering and keep us clear of rate limits. A handful of blocking fetches
+    # per run doesn't warrant an asyncio/aiohttp port; threads overlap the I/O
+    # just as well and keep the rest of the script synchronous.
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        results = list(zip(candidates, executor.map(fetch_post_metadata, candidates)))
+
+    for post, metadata in results:
+        if metadata is False:
+            print(f"Failed to fetch metadata for {post.url}, skipping")
+            run_complete = False
+        else:
             tb = client_utils.TextBuilder()
             
             tb.text('A new ')
@@ -224,7 +348,7 @@ if __name__ == "__main__":
                 tb.text('speech')
             tb.text(' is available')
             if len(metadata['ministers']):
-                tb.text(format_minister_text(metadata['ministers']))
+                tb.text(format_minister_text(tuple(metadata['ministers'])))
             # if len(metadata['portfolios']):
             #     tb.text(f', Minister for {metadata["portfolios"][0]}')
             tb.text('.')
@@ -243,23 +367,17 @@ if __name__ == "__main__":
                     os.environ.get("BLUESKY_PASSWORD", False)
                 )
 
-                # In order to avoid wasted bandwidth, as the image is always the same, we'll just upload
-                # a local copy and update it periodically.
-                with open(os.path.join(SCRIPT_DIR, 'beehive.png'), 'rb') as file:
-                    img_data = file.read()
-                thumb = client.upload_blob(img_data)
                 embed = models.AppBskyEmbedExternal.Main(
                     external=models.AppBskyEmbedExternal.External(
                         title=embed_title,
                         description=embed_description,
                         uri=post.url,
-                        thumb=thumb.blob,
+                        thumb=get_thumb_blob(client),
                     )
                 )
                 try:
                     client.send_post(tb, embed=embed)
-                    save_feed_history(history, post)
-                    posts_published += 1
+                    save_feed_history(guids, post)
                     print(f"Successfully posted {post.url}")
                     # If we have a bunch of new posts, we don't want to spam readers. We'll also avoid any
                     # potential Bluesky rate limits.
@@ -267,6 +385,7 @@ if __name__ == "__main__":
                 except Exception as e:
                     # We failed to publish a post presumably so we don't want to save to history
                     print(f"Failed to post {post.url}: {e}")
+                    run_complete = False
                     continue
             else:
                 print(tb.build_text())
@@ -275,5 +394,9 @@ if __name__ == "__main__":
                 print(embed_description)
                 print(post.url)
                 print('----')
-                save_feed_history(history, post)
-                posts_published += 1
+                save_feed_history(guids, post)
+
+    # Remember this feed body only if nothing was deferred or failed above,
+    # so an incomplete run re-parses the same feed and retries next time
+    if run_complete and feed_hash is not None:
+        save_feed_state(feed_hash)